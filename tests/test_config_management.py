@@ -35,6 +35,15 @@ def test_read_smokeping_config():
     assert targets == [{'target': 'www.cdn77.com', 'name': 'ANYCAST CDN77 (AS60068 www.cdn77.com)'}, {'target': '1.1.1.1', 'name': 'ANYCAST Cloudflare (AS13335 1.1.1.1)'}, {'target': '192.175.48.1', 'name': 'ANYCAST DNS-OARC (AS112 192.175.48.1)'}, {'target': 'www.googleapis.com', 'name': 'ANYCAST Google API (AS15169 www.googleapis.com)'}, {'target': '8.8.8.8', 'name': 'ANYCAST Google DNS (AS15169 8.8.8.8)'}, {'target': 'drive.google.com', 'name': 'ANYCAST Google DRIVE (AS15169 drive.google.com)'}, {'target': '9.9.9.9', 'name': 'ANYCAST Quad9 (AS19281 9.9.9.9)'}, {'target': 'ns1.wordpress.com', 'name': 'ANYCAST WordPress (AS2635 ns1.wordpress.com)'}, {'target': 'ovh.es', 'name': '[FR] ISP OVH (AS16276 ovh.es)'}, {'target': 'nsa.online.net', 'name': '[FR] ISP Online.net (AS12876 nsa.online.net)'}, {'target': 'hetzner.com', 'name': '[DE] ISP Hetzner (AS24940 hetzner.com)'}], "Bogus smokeping example 3 test with inclusions"
     print(targets)
 
+
+def test_parse_smokeping_line():
+    assert config_management.parse_smokeping_line("host = pc1") == ('host', 'pc1')
+    assert config_management.parse_smokeping_line("  title = Apache 2 Server for noc  ") == ('title', 'Apache 2 Server for noc')
+    assert config_management.parse_smokeping_line("# host = pc1") == (None, None)
+    assert config_management.parse_smokeping_line("+ pc1") == (None, None)
+
+
 if __name__ == "__main__":
     print("Example code for %s, %s" % (__intname__, __build__))
     test_read_smokeping_config()
+    test_parse_smokeping_line()
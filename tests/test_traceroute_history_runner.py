@@ -0,0 +1,170 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of ofunctions module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.traceroute_history_runner"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022050601"
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from traceroute_history import traceroute_history_runner, trparse, models, schemas
+
+LINUX_TRACEROUTE = """traceroute to example.com (93.184.216.34), 30 hops max, 60 byte packets
+ 1  _gateway (192.168.1.1)  0.512 ms  0.480 ms  0.470 ms
+ 2  10.10.0.1 (10.10.0.1)  5.120 ms  5.010 ms  4.990 ms
+ 3  * * *
+ 4  * 172.16.0.1 (172.16.0.1)  12.300 ms  12.100 ms
+ 5  93.184.216.34 (93.184.216.34)  20.100 ms  20.000 ms  19.900 ms
+"""
+
+WINDOWS_TRACEROUTE = """
+Tracing route to example.com [93.184.216.34]
+over a maximum of 30 hops:
+
+  1    <1 ms    <1 ms    <1 ms  192.168.1.1
+  2     5 ms     4 ms     5 ms  10.10.0.1
+  3     *        *        *     Request timed out.
+  4    20 ms    19 ms    20 ms  example.com [93.184.216.34]
+
+Trace complete.
+"""
+
+IPV6_TRACEROUTE = """traceroute to example.com (2606:2800:220:1:248:1893:25c8:1946), 30 hops max, 80 byte packets
+ 1  router.lan (2001:db8::1)  0.612 ms  0.580 ms  0.570 ms
+ 2  2001:db8:ffff::1 (2001:db8:ffff::1)  8.120 ms  8.010 ms  7.990 ms
+ 3  * * *
+ 4  example.com (2606:2800:220:1:248:1893:25c8:1946)  90.100 ms  90.000 ms  89.900 ms
+"""
+
+TIMEOUT_TRACEROUTE = """traceroute to example.com (93.184.216.34), 30 hops max, 60 byte packets
+ 1  * * *
+ 2  * * *
+ 3  * * *
+"""
+
+MULTI_IP_TRACEROUTE = """traceroute to example.com (93.184.216.34), 30 hops max, 60 byte packets
+ 1  _gateway (192.168.1.1)  0.512 ms  0.480 ms  0.470 ms
+ 2  10.10.0.1 (10.10.0.1)  5.120 ms 10.10.0.2 (10.10.0.2)  5.010 ms  4.990 ms
+ 3  172.16.0.1 (172.16.0.1)  12.300 ms
+    172.16.0.2 (172.16.0.2)  12.100 ms
+    172.16.0.3 (172.16.0.3)  12.000 ms
+ 4  93.184.216.34 (93.184.216.34)  20.100 ms  20.000 ms  19.900 ms
+"""
+
+SAMPLES = [LINUX_TRACEROUTE, WINDOWS_TRACEROUTE, IPV6_TRACEROUTE, TIMEOUT_TRACEROUTE, MULTI_IP_TRACEROUTE]
+
+
+def trparse_hop_ips(raw_traceroute):
+    return [hop.probes[0].ip or '*' for hop in trparse.loads(raw_traceroute).hops]
+
+
+def test_get_hop_ips():
+    for raw_traceroute in SAMPLES:
+        assert traceroute_history_runner.get_hop_ips(raw_traceroute) == trparse_hop_ips(raw_traceroute), \
+            "Hop ips differ from trparse for {}".format(raw_traceroute)
+
+    assert traceroute_history_runner.get_hop_ips(LINUX_TRACEROUTE) == \
+        ['192.168.1.1', '10.10.0.1', '*', '172.16.0.1', '93.184.216.34']
+    assert traceroute_history_runner.get_hop_ips(WINDOWS_TRACEROUTE) == \
+        ['192.168.1.1', '10.10.0.1', '*', '93.184.216.34']
+    assert traceroute_history_runner.get_hop_ips('Cannot execute traceroute') == []
+
+
+def test_get_hop_fingerprint():
+    assert traceroute_history_runner.get_hop_fingerprint(TIMEOUT_TRACEROUTE) == '*,*,*'
+    assert traceroute_history_runner.get_hop_fingerprint('Cannot execute traceroute') is None
+
+
+def test_get_hop_digest():
+    linux_rtt_change = LINUX_TRACEROUTE.replace('0.512 ms', '10.512 ms').replace('20.100 ms', '9.100 ms')
+    windows_rtt_change = WINDOWS_TRACEROUTE.replace('  1    <1 ms    <1 ms    <1 ms', '  1     1 ms    <1 ms     2 ms') \
+        .replace('  2     5 ms', '  2    15 ms')
+    changed_hop = LINUX_TRACEROUTE.replace('10.10.0.1 (10.10.0.1)', '10.20.0.1 (10.20.0.1)')
+
+    assert traceroute_history_runner.get_hop_digest(linux_rtt_change) == \
+        traceroute_history_runner.get_hop_digest(LINUX_TRACEROUTE)
+    assert traceroute_history_runner.get_hop_digest(windows_rtt_change) == \
+        traceroute_history_runner.get_hop_digest(WINDOWS_TRACEROUTE)
+    assert traceroute_history_runner.get_hop_digest(changed_hop) != \
+        traceroute_history_runner.get_hop_digest(LINUX_TRACEROUTE)
+
+
+def test_update_traceroute_database():
+    engine = create_engine('sqlite://')
+    models.init_db(engine)
+    db = sessionmaker(bind=engine)()
+    target = schemas.TargetCreate(name='example', address='93.184.216.34')
+
+    traceroute = traceroute_history_runner.update_traceroute_database(db, target, 0, LINUX_TRACEROUTE)
+    assert traceroute is not None, "First traceroute of a target should be stored"
+    db.add(traceroute)
+    db.flush()
+
+    rtt_change = LINUX_TRACEROUTE.replace('5.120 ms', '95.120 ms')
+    hostname_change = LINUX_TRACEROUTE.replace('_gateway (192.168.1.1)', 'router.lan (192.168.1.1)')
+    changed_hop = LINUX_TRACEROUTE.replace('10.10.0.1 (10.10.0.1)', '10.20.0.1 (10.20.0.1)')
+
+    # Digest and fingerprint comparisons must not need to parse traceroutes
+    traceroutes_equal = traceroute_history_runner.traceroutes_equal
+
+    def _no_parsing(*args, **kwargs):
+        raise AssertionError('traceroutes_equal should not be needed')
+
+    traceroute_history_runner.traceroutes_equal = _no_parsing
+    try:
+        assert traceroute_history_runner.update_traceroute_database(db, target, 0, rtt_change) is None, \
+            "Rtt only change should be skipped by digest"
+        assert traceroute_history_runner.update_traceroute_database(db, target, 0, hostname_change) is None, \
+            "Hostname only change should be skipped by fingerprint"
+    finally:
+        traceroute_history_runner.traceroutes_equal = traceroutes_equal
+
+    traceroute = traceroute_history_runner.update_traceroute_database(db, target, 0, changed_hop)
+    assert traceroute is not None, "Changed hop should be stored"
+    assert traceroute.hop_fingerprint == '192.168.1.1,10.20.0.1,*,172.16.0.1,93.184.216.34'
+    assert traceroute_history_runner.update_traceroute_database(db, target, 0, rtt_change,
+                                                                rtt_detection_threshold=50) is not None, \
+        "Rtt increase should be stored when rtt detection is enabled"
+    db.close()
+
+
+def test_traceroutes_equal():
+    changed_hop = LINUX_TRACEROUTE.replace('10.10.0.1 (10.10.0.1)', '10.20.0.1 (10.20.0.1)')
+    increased_rtt = LINUX_TRACEROUTE.replace('5.120 ms', '95.120 ms')
+    missing_hop = LINUX_TRACEROUTE.replace(' 5  93.184.216.34 (93.184.216.34)  20.100 ms  20.000 ms  19.900 ms\n', '')
+    traceroutes = SAMPLES + [changed_hop, increased_rtt, missing_hop]
+
+    for rtt_detection_threshold in (0, 50):
+        for current_tr in traceroutes:
+            for previous_tr in traceroutes:
+                different_hops, increased_rtts = traceroute_history_runner.analyze_traceroutes(
+                    current_tr, previous_tr, rtt_detection_threshold=rtt_detection_threshold)
+                assert traceroute_history_runner.traceroutes_equal(
+                    current_tr, previous_tr, rtt_detection_threshold=rtt_detection_threshold) == \
+                    (not different_hops and not increased_rtts), \
+                    "traceroutes_equal differs from analyze_traceroutes with threshold {}".format(rtt_detection_threshold)
+
+    assert traceroute_history_runner.traceroutes_equal(increased_rtt, LINUX_TRACEROUTE)
+    assert not traceroute_history_runner.traceroutes_equal(increased_rtt, LINUX_TRACEROUTE, rtt_detection_threshold=50)
+    assert not traceroute_history_runner.traceroutes_equal(changed_hop, LINUX_TRACEROUTE)
+    assert not traceroute_history_runner.traceroutes_equal('Cannot execute traceroute', 'Cannot execute traceroute')
+
+
+if __name__ == "__main__":
+    print("Example code for %s, %s" % (__intname__, __build__))
+    test_get_hop_ips()
+    test_get_hop_fingerprint()
+    test_get_hop_digest()
+    test_update_traceroute_database()
+    test_traceroutes_equal()
@@ -20,31 +20,49 @@ import os
 from logging import getLogger
 import re
 import configparser
+from typing import List, NamedTuple
 from traceroute_history import exceptions
 
 logger = getLogger(__name__)
 
-# Don't add $ since we could have some comments afterwards
-COMMENT_REGEX = re.compile(r"\s*#")
-SMOKEPING_TARGET_REGEX = re.compile(r'.*host\s*=\s*(\S*)', re.IGNORECASE)
-SMOKEPING_TITLE_REGEX = re.compile(r'.*title\s*=\s*(.*)$', re.IGNORECASE)
+# Parsed config objects and config file modification times by config file path
+CONFIG_CACHE = {}
+
+
+class TargetConfig(NamedTuple):
+    """
+    Target as read from config files
+    """
+    name: str
+    address: str
+    groups: List[str]
 
 
 def load_config(config_file):
     """
     Loads config from file
+    Config files are parsed again only when they have been modified, otherwise the same config object is returned
+    Callers modifying the config object must save it with save_config, which invalidates the cache
 
+    :param config_file: (str) path to config file
     :return: (ConfigParser) config object
     """
-    global CONFIG
-
     if config_file is None or not os.path.isfile(config_file):
         raise exceptions.ConfigFileNotFound("Cannot load config file {}".format(config_file))
+    mtime = os.path.getmtime(config_file)
+    try:
+        cached_mtime, config = CONFIG_CACHE[config_file]
+        if cached_mtime == mtime:
+            return config
+    except KeyError:
+        pass
+
     config = configparser.ConfigParser()
     try:
         config.read(config_file)
     except (configparser.MissingSectionHeaderError, KeyError):
         raise exceptions.ConfigFileNotParseable("Config file {} is not parseable.".format(config_file))
+    CONFIG_CACHE[config_file] = (mtime, config)
     return config
 
 
@@ -65,6 +83,26 @@ def save_config(config_file, config):
     except OSError as exc:
         logger.critical('Cannot save configuration file. {}'.format(exc))
         return False
+    finally:
+        # Cached config object may have been modified, or not match the file anymore
+        CONFIG_CACHE.pop(config_file, None)
+
+def parse_smokeping_line(line):
+    """
+    Splits a smokeping config line into key and value
+    Smokeping syntax is simple enough that we don't need regexes for this
+
+    :param line: (str) config line
+    :return: (str, str) lowercase key and value, (None, None) if line is a comment or has no key
+    """
+    stripped_line = line.lstrip()
+    if stripped_line.startswith('#'):
+        return None, None
+    key, separator, value = stripped_line.partition('=')
+    if not separator:
+        return None, None
+    return key.rstrip().lower(), value.strip()
+
 
 def read_include_file(include_file):
     """
@@ -76,12 +114,11 @@ def read_include_file(include_file):
 
     with open(include_file, 'r', encoding="utf-8") as smokeping_include_config:
         for line in smokeping_include_config:
-            target = re.match(SMOKEPING_TARGET_REGEX, line)
-            target_name = re.match(SMOKEPING_TITLE_REGEX, line)
-            if target:
-                targets.append(target)
-            if target_name:
-                target_names.append(target_name)
+            key, value = parse_smokeping_line(line)
+            if key == 'host':
+                targets.append(value.split(None, 1)[0] if value else value)
+            elif key == 'title':
+                target_names.append(value)
     return targets, target_names
 
 def read_smokeping_config(config_file):
@@ -140,15 +177,11 @@ def read_smokeping_config(config_file):
                 if ln.startswith("+"):
                     host_counter += 1
 
-                if re.match(COMMENT_REGEX, ln):
-                    continue
-                target = re.match(SMOKEPING_TARGET_REGEX, ln)
-                target_name = re.match(SMOKEPING_TITLE_REGEX, ln)
-
-                if target:
-                    targets[host_counter] = target.group(1)
-                if target_name:
-                    target_names[host_counter] = target_name.group(1)
+                key, value = parse_smokeping_line(ln)
+                if key == 'host':
+                    targets[host_counter] = value.split(None, 1)[0] if value else value
+                elif key == 'title':
+                    target_names[host_counter] = value
 
 
     # TODO Add regex for group inclusion / exclusion
@@ -174,7 +207,7 @@ def get_targets_from_config(config):
     for section in config.sections():
         if section.startswith("TARGET:"):
             target = {}
-            target['name'] = section.lstrip("TARGET:")
+            target['name'] = section[len("TARGET:"):]
             target['address'] = config[section]['address']
             targets.append(target)
     #targets = [section.lstrip('TARGET:') for section in config.sections() if section.startswith('TARGET:')]
@@ -188,6 +221,25 @@ def get_targets_from_config(config):
     return targets
 
 
+def get_target_configs(config):
+    """
+    Reads all targets with their groups from config and smokeping config in a single pass
+
+    :param config: (ConfigParser) config object
+    :return: (list)(TargetConfig) list of targets
+    """
+    target_configs = []
+    for target in get_targets_from_config(config):
+        # Smokeping targets may not have a title
+        name = target.get('name', target['address'])
+        try:
+            groups = [group.strip() for group in config['TARGET:' + name]['groups'].split(',')]
+        except KeyError:
+            groups = []
+        target_configs.append(TargetConfig(name=name, address=target['address'], groups=groups))
+    return target_configs
+
+
 def get_groups_from_config(config, target_name):
     targets = get_targets_from_config(config)
     for target in targets:
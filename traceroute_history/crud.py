@@ -17,7 +17,7 @@ __version__ = '0.4.1'
 __build__ = '2020092202'
 
 
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload
 from traceroute_history import schemas, models
 
 
@@ -29,7 +29,8 @@ def get_target(db: Session, id: int = None, name: str = None):
 
 
 def get_targets(db: Session, skip: int = 0, limit: int = None):
-    return db.query(models.Target).offset(skip).limit(limit).all()
+    # Load groups of all targets in one query instead of one query per target
+    return db.query(models.Target).options(selectinload(models.Target.groups)).offset(skip).limit(limit).all()
 
 
 def create_target(db: Session, target: schemas.TargetCreate):
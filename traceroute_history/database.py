@@ -19,7 +19,7 @@ __build__ = '2020050601'
 import os
 import sys
 from logging import getLogger
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, scoped_session
 import sqlalchemy.exc
 from contextlib import contextmanager
@@ -45,17 +45,17 @@ def get_db():
 @contextmanager
 def db_scoped_session():
     """Provide a transactional scope around a series of operations."""
+    # SessionLocal is a scoped_session, so every thread gets it's own session
     session = SessionLocal()
     try:
         yield session
         session.commit()
-        session.flush()
     except:
         session.rollback()
         raise
     finally:
-        pass #TODO
-        #session.close()
+        # Close the thread local session, objects that need to outlive it must be expunged beforehand
+        SessionLocal.remove()
 
 def load_database(config, initialize=False):
     """
@@ -104,10 +104,28 @@ def load_database(config, initialize=False):
         try:
             logger.debug('Trying to open {0} database "{1}{2}" as user "{2}".'.format(db_driver, db_host, db_name, db_user, db_password))
 
-            # FastAPI will use more than one thread to interact with the database for a single request
-            # We need to disable thread check
-            # Warning: Check that we always use different threads when using scheduler
-            engine = create_engine(connection_string, connect_args={'check_same_thread': False})
+            if db_driver == 'sqlite':
+                # FastAPI will use more than one thread to interact with the database for a single request
+                # We need to disable thread check
+                # Warning: Check that we always use different threads when using scheduler
+                engine = create_engine(connection_string, echo=False, connect_args={'check_same_thread': False})
+
+                # pysqlite only opens transactions before DML statements, so savepoints would commit on release
+                # Let SQLAlchemy emit BEGIN itself so savepoints happen inside the session's transaction
+                @event.listens_for(engine, 'connect')
+                def _disable_pysqlite_transactions(dbapi_connection, connection_record):
+                    dbapi_connection.isolation_level = None
+
+                @event.listens_for(engine, 'begin')
+                def _begin_transaction(conn):
+                    # exec_driver_sql only exists since SQLAlchemy 1.4
+                    getattr(conn, 'exec_driver_sql', conn.execute)('BEGIN')
+            else:
+                # Keep warm connections in a LIFO pool so idle overflow connections time out, and make sure
+                # connections survive database restarts
+                engine = create_engine(connection_string, echo=False, pool_size=5, max_overflow=10,
+                                       pool_timeout=30, pool_recycle=3600, pool_pre_ping=True,
+                                       pool_use_lifo=True)
             session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
             SessionLocal =  scoped_session(session_factory)
             return SessionLocal
@@ -17,7 +17,7 @@ __version__ = '0.4.0'
 __build__ = '2020050601'
 
 
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Table
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Table, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 #from traceroute_history.database import Base
@@ -31,9 +31,16 @@ class Traceroute(Base):
     id = Column(Integer, primary_key=True)
     creation_date = Column(DateTime(timezone=True), server_default=func.now())  # using func.now() guarantees UTC data
     raw_traceroute = Column(String(2048), nullable=False)
+    # Comma separated first probe ips of every hop, allows comparing hops without parsing traceroutes
+    hop_fingerprint = Column(String(2048), nullable=True)
+    # sha256 digest of raw traceroute without rtts, allows spotting identical traceroutes without parsing them
+    hop_digest = Column(String(64), nullable=True)
     target_id = Column(Integer, ForeignKey('target.id'))
     target = relationship('Target')
 
+    # Traceroutes are always looked up by target, newest first
+    __table_args__ = (Index('ix_traceroute_target_id_id', 'target_id', 'id'),)
+
     def __repr__(self):
         return 'Traceroute recorded at {0}:\n {1}'.format(self.creation_date, self.raw_traceroute)
 
@@ -20,13 +20,16 @@ __build__ = '2022050601'
 import os
 import sys
 import getopt
+import asyncio
+import re
+import hashlib
+import io
+import threading
+import signal
 import ofunctions.logger_utils
 from apscheduler.schedulers.background import BackgroundScheduler
-from time import sleep
-from sqlalchemy import and_
 import sqlalchemy.exc
 from datetime import datetime, timedelta
-from command_runner import command_runner
 import json
 from decimal import Decimal
 from traceroute_history import config_management, trparse, schemas, models, crud
@@ -38,11 +41,35 @@ try:
     import colorama
     if os.name == 'nt':
         colorama.init(convert=True)
+    CONSOLE_GREEN_COLOR = colorama.Back.LIGHTGREEN_EX + colorama.Fore.BLACK
+    CONSOLE_RED_COLOR = colorama.Back.LIGHTRED_EX + colorama.Fore.BLACK
 except ImportError:
-    pass
+    CONSOLE_GREEN_COLOR = '\033[102m'
+    CONSOLE_RED_COLOR = '\033[101m'
+
+# Green, red and end color sequences per output formatting
+COLOR_FORMATS = {
+    'web': ('<span class="green traceroute-green" style="background-color: darkgreen; color:white">',
+            '<span class="red traceroute-red" style="background-color: darkred; color:white">',
+            '</span>'),
+    'console': (CONSOLE_GREEN_COLOR, CONSOLE_RED_COLOR, '\033[0m')
+}
 
 CONFIG_FILE = 'traceroute_history.conf'
 
+# Number of new traceroutes from which we use bulk inserts
+BULK_INSERT_THRESHOLD = 50
+
+# Maximum number of traceroutes running at the same time
+MAX_CONCURRENT_TRACEROUTES = 16
+
+# Seconds after which a traceroute that did not finish is killed
+TRACEROUTE_TIMEOUT = 3600
+
+# rtt values in traceroute outputs, eg '5.120 ms' or '<1 ms'
+# Leading whitespace is included since tracert right aligns rtts, so the padding depends on the rtt value
+RTT_REGEX = re.compile(r'\s*<?\d+(?:\.\d+)?\s*ms')
+
 LOG_FILE = os.path.join(os.path.dirname(__file__), os.path.splitext(os.path.basename(__file__))[0]) + '.log'
 logger = ofunctions.logger_utils.logger_get_logger(log_file=LOG_FILE)
 
@@ -59,21 +86,7 @@ def format_string(string: str, formatting: str='console'):
     if string is None or string is []:
         return string
 
-    if formatting == 'web':
-        green_color = '<span class="green traceroute-green" style="background-color: darkgreen; color:white">'
-        red_color = '<span class="red traceroute-red" style="background-color: darkred; color:white">'
-        end_color = '</span>'
-    elif formatting == 'console':
-        try:
-            green_color = colorama.Back.LIGHTGREEN_EX + colorama.Fore.BLACK
-            red_color = colorama.Back.LIGHTRED_EX + colorama.Fore.BLACK
-        except NameError:
-            # missing colorama module ?
-            green_color = '\033[102m'
-            red_color = '\033[101m'
-        end_color = '\033[0m'
-    else:
-        green_color = red_color = end_color = ''
+    green_color, red_color, end_color = COLOR_FORMATS.get(formatting, ('', '', ''))
 
     string = string.replace('{% START_COLOR_GREEN %}', green_color)
     string = string.replace('{% START_COLOR_RED %}', red_color)
@@ -140,58 +153,157 @@ def analyze_traceroutes(current_tr: str, previous_tr: str, rtt_detection_thresho
     return different_hops, increased_rtt
 
 
-def traceroutes_difference_preformatted(tr1: models.Traceroute, tr2: models.Traceroute):
+def traceroutes_equal(current_tr: str, previous_tr: str, rtt_detection_threshold: int=0):
     """
-    Outputs traceroute differences with color highlighting in console
+    Checks whether two traceroutes have the same hops and no increased rtt, stopping at the first difference
+    Use analyze_traceroutes in order to get all differences
+
+    :param current_tr: (str) raw traceroute output
+    :param previous_tr: (str) raw traceroute output
+    :param rtt_detection_threshold: (int) rtt increase in ms that makes traceroutes differ, 0 disables rtt detection
+    :return: (bool) True if traceroutes are identical, False if they differ or cannot be parsed
+    """
+    # Comparing hop ips doesn't need full traceroute parsing
+    if rtt_detection_threshold == 0:
+        current_hop_ips = get_hop_ips(current_tr)
+        return bool(current_hop_ips) and current_hop_ips == get_hop_ips(previous_tr)
+
+    try:
+        current_hops = trparse.loads(current_tr).hops
+        previous_hops = trparse.loads(previous_tr).hops
+    except (trparse.ParseError, IndexError):
+        return False
+
+    if len(current_hops) != len(previous_hops):
+        return False
+
+    for current_hop, previous_hop in zip(current_hops, previous_hops):
+        try:
+            current_probe = current_hop.probes[0]
+            previous_probe = previous_hop.probes[0]
+        except IndexError:
+            return False
+        if current_probe.ip != previous_probe.ip:
+            return False
+        # Timeouts that did respond earlier
+        if current_probe.rtt is None and isinstance(previous_probe.rtt, Decimal):
+            return False
+        try:
+            if current_probe.rtt > previous_probe.rtt + rtt_detection_threshold:
+                return False
+        except TypeError:
+            pass
+    return True
+
+
+def get_hop_ips(raw_traceroute: str):
+    """
+    Extracts the first probe ip of every hop without building trparse objects
+    Uses trparse regexes, so ips are the same as trparse's first probe ips
+
+    :param raw_traceroute: (str) raw traceroute output
+    :return: (list)(str) hop ips, '*' for hops without ip
+    """
+    hop_ips = []
+    for line in raw_traceroute.splitlines():
+        hop_match = trparse.RE_FIRST_HOP.match(line)
+        if not hop_match:
+            continue
+        hop_string = hop_match.group(2)
+        probe_name_ip_match = trparse.RE_PROBE_NAME_IP.search(hop_string)
+        if probe_name_ip_match:
+            hop_ips.append(probe_name_ip_match.group(2) or probe_name_ip_match.group(3))
+            continue
+        # Windows and numeric outputs only have ips
+        probe_ip_match = trparse.RE_PROBE_IP_ONLY.search(hop_string)
+        hop_ips.append(probe_ip_match.group(1) if probe_ip_match else '*')
+    return hop_ips
+
+
+def get_hop_fingerprint(raw_traceroute: str):
+    """
+    Computes a compact representation of traceroute hops, made of the first probe ip of every hop
+
+    :param raw_traceroute: (str) raw traceroute output
+    :return: (str) comma separated hop ips, None if traceroute has no hops
+    """
+    hop_ips = get_hop_ips(raw_traceroute)
+    if not hop_ips:
+        return None
+    return ','.join(hop_ips)
+
+
+def get_hop_digest(raw_traceroute: str):
+    """
+    Computes a digest of traceroute output without rtt values, so identical routes can be spotted without parsing
+
+    :param raw_traceroute: (str) raw traceroute output
+    :return: (str) sha256 hex digest
+    """
+    return hashlib.sha256(RTT_REGEX.sub('', raw_traceroute).encode('utf-8')).hexdigest()
+
+
+def write_traceroutes_difference(buf: io.StringIO, tr1: models.Traceroute, tr2: models.Traceroute):
+    """
+    Writes traceroute differences with color highlighting placeholders to a buffer
+
+    :param buf: (io.StringIO) buffer to write to
     :param tr1: (Traceroute) Traceroute model object
     :param tr2: (Traceroute) Tracerouet model object
-    :return: (str) diff colorred traceroute outputs
+    :return:
     """
 
-    try:
-        config = config_management.load_config(CONFIG_FILE)
-        rtt_detection_threshold = int(config['TRACEROUTE_HISTORY']['rtt_detection_threshold'])
-    except KeyError:
-        rtt_detection_threshold = 0
-    except TypeError:
-        logger.warning('Bogus rtt_detection_threshold value.')
-        rtt_detection_threshold = 0
+    config = config_management.load_config(CONFIG_FILE)
+    rtt_detection_threshold = get_rtt_detection_threshold(config)
     different_hops, increased_rtt = analyze_traceroutes(tr1.raw_traceroute, tr2.raw_traceroute, rtt_detection_threshold=rtt_detection_threshold)
 
-
+    if different_hops is None or increased_rtt is None:
+        buf.write('Cannot parse TR') # TODO
+        return
 
     def _console_output(tr, color):
-        console_output = ''
         for line in tr.split('\n'):
             # Check that line is a hop, also, hops
             try:
                 # Since we count hop indexes from 0 in trparse, and hop output starts with 1
                 index = int(line.split()[0])
             except (TypeError, IndexError, ValueError):
-                console_output = '{0}{1}\n'.format(console_output, line)
+                buf.write(line)
+                buf.write('\n')
                 continue
             if index in different_hops or index in increased_rtt:
-                console_output = '{0}{1}{2}{3}\n'.format(console_output, color, line, '{% END_COLOR %}')
+                buf.write(color)
+                buf.write(line)
+                buf.write('{% END_COLOR %}\n')
             else:
-                console_output = '{0}{1}\n'.format(console_output, line)
-        return console_output
+                buf.write(line)
+                buf.write('\n')
 
-    try:
-        return 'Traceroute recorded at {0}:\n{1}Traceroute recorded at {2}:\n{3}'.format(tr1.creation_date,
-                                                                                     _console_output(tr1.raw_traceroute,
-                                                                                                     '{% START_COLOR_GREEN %}'),
-                                                                                     tr2.creation_date,
-                                                                                     _console_output(tr2.raw_traceroute,
-                                                                                                     '{% START_COLOR_RED %}'))
-    except TypeError:
-        return 'Cannot parse TR' # TODO
+    buf.write('Traceroute recorded at {0}:\n'.format(tr1.creation_date))
+    _console_output(tr1.raw_traceroute, '{% START_COLOR_GREEN %}')
+    buf.write('Traceroute recorded at {0}:\n'.format(tr2.creation_date))
+    _console_output(tr2.raw_traceroute, '{% START_COLOR_RED %}')
 
-def os_traceroute(address):
+
+def traceroutes_difference_preformatted(tr1: models.Traceroute, tr2: models.Traceroute):
+    """
+    Outputs traceroute differences with color highlighting in console
+    :param tr1: (Traceroute) Traceroute model object
+    :param tr2: (Traceroute) Tracerouet model object
+    :return: (str) diff colorred traceroute outputs
     """
-    Launches actuel traceroute binary
+    buf = io.StringIO()
+    write_traceroutes_difference(buf, tr1, tr2)
+    return buf.getvalue()
+
+
+async def os_traceroute(address):
+    """
+    Launches actual traceroute binary
+    Address is passed as argument without any shell so it cannot be interpreted
 
     :param address: (str) address
-    :return: (str) raw traceroute output
+    :return: (int, str) exit code, raw traceroute output
     """
     if address:
         if os.name == 'nt':
@@ -202,8 +314,33 @@ def os_traceroute(address):
         else:
             executable = 'traceroute'
             encoding = 'utf-8'
-        command = '{0} {1}'.format(executable, address)
-        exit_code, output = command_runner(command, shell=True, encoding=encoding)
+        try:
+            process = await asyncio.create_subprocess_exec(executable, address, stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.STDOUT)
+        except OSError as exc:
+            logger.error('Cannot execute "{0}": {1}.'.format(executable, exc))
+            return 1, 'Cannot execute {0}: {1}'.format(executable, exc)
+        # Decode hop lines as traceroute emits them instead of decoding the whole output once it's finished
+        lines = []
+
+        async def _read_output():
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    break
+                lines.append(line.decode(encoding, errors='replace'))
+            return await process.wait()
+
+        try:
+            exit_code = await asyncio.wait_for(_read_output(), TRACEROUTE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # A hung traceroute would otherwise block every following run
+            process.kill()
+            await process.wait()
+            logger.error('Traceroute to address: "{0}" timed out after {1} seconds.'.format(address, TRACEROUTE_TIMEOUT))
+            lines.append('Timeout after {0} seconds\n'.format(TRACEROUTE_TIMEOUT))
+            return 1, ''.join(lines)
+        output = ''.join(lines)
         if exit_code != 0:
             logger.error(
                 'Traceroute to address: "{0}" failed with exit code {1}. Command output:'.format(address, exit_code))
@@ -212,71 +349,230 @@ def os_traceroute(address):
     return 1, 'Bogus address given.'
 
 
-def update_traceroute_database(target: schemas.TargetCreate):
+async def os_traceroutes(addresses: list):
+    """
+    Launches traceroutes concurrently, with at most MAX_CONCURRENT_TRACEROUTES running at the same time
+
+    :param addresses: (list)(str) addresses
+    :return: (list)(int, str) exit code and raw traceroute output for every address, in the same order
     """
-    Executes tracert for given name, and updates database accordingly
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_TRACEROUTES)
 
-    :param target_name: (str) target user friendly name (can be anything)
-    :param address: (str) hostname in fqdn, ipv4 or ipv6 format
-    :param groups: (list)(str) list of groups to which this target belongs
+    async def _bounded_traceroute(address):
+        async with semaphore:
+            try:
+                return await os_traceroute(address)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                # Don't lose the results of other targets because of one failing traceroute
+                logger.error('Traceroute to address: "{0}" failed: {1}.'.format(address, exc))
+                logger.debug('Trace:', exc_info=True)
+                return 1, 'Traceroute failed: {0}'.format(exc)
+
+    return await asyncio.gather(*[_bounded_traceroute(address) for address in addresses])
+
+
+def new_event_loop():
+    """
+    Creates an event loop that is able to run subprocesses on all platforms
+    Must be called from the main thread, since the child watcher needs to install a signal handler before Python 3.8
+
+    :return: (AbstractEventLoop) event loop
+    """
+    if os.name == 'nt':
+        # Default windows event loop does not support subprocesses before Python 3.8
+        return asyncio.ProactorEventLoop()
+    loop = asyncio.new_event_loop()
+    if sys.version_info < (3, 8):
+        # Before Python 3.8, subprocess exits are only noticed by the loop attached to the child watcher
+        asyncio.get_child_watcher().attach_loop(loop)
+    return loop
+
+
+def get_rtt_detection_threshold(config):
+    """
+    Reads rtt detection threshold from config
+
+    :param config: (ConfigParser) config object
+    :return: (int) threshold in ms, 0 means rtt detection is disabled
+    """
+    try:
+        return int(config['TRACEROUTE_HISTORY']['rtt_detection_threshold'])
+    except KeyError:
+        return 0
+    except (TypeError, ValueError):
+        logger.warning('Bogus rtt_detection_threshold value.')
+        return 0
+
+
+def get_or_create_target(db, target: schemas.TargetCreate):
+    """
+    Gets target from database, or creates it with it's groups if it does not exist
+    Does not commit, so creation happens in the caller's transaction
+
+    :param db: (Session) database session
+    :param target: (schemas.TargetCreate) target to get or create
+    :return: (models.Target) target object
+    """
+    tgt = crud.get_target(db=db, name=target.name)
+    if tgt:
+        return tgt
+
+    # Create groups if not exist
+    tgt_groups = []
+    if target.groups:
+        for group in target.groups:
+            grp = crud.get_group(db=db, name=group.name)
+            if not grp:
+                grp = models.Group(name=group.name)
+                db.add(grp)
+                # Flush so next targets of this batch find the group
+                db.flush()
+                logger.info('Created new group "{0}".'.format(group.name))
+            tgt_groups.append(grp)
+
+    # Make IPv4 or IPv6 a string so SQLAlchemy is happy only being able to store a string
+    tgt = models.Target(name=target.name, address=str(target.address), groups=tgt_groups)
+    db.add(tgt)
+    # Flush so we get a target id
+    db.flush()
+    logger.info('Created new target "{0}".'.format(target.name))
+    return tgt
+
+
+def update_traceroute_database(db, target: schemas.TargetCreate, exit_code: int, raw_traceroute: str,
+                               rtt_detection_threshold: int=0):
+    """
+    Compares a traceroute result with the last one stored for given target
+    Does not commit, so the caller can batch multiple targets in one transaction
+
+    :param db: (Session) database session
+    :param target: (schemas.TargetCreate) target the traceroute was made for
+    :param exit_code: (int) traceroute exit code
+    :param raw_traceroute: (str) raw traceroute output
+    :param rtt_detection_threshold: (int) rtt increase in ms that triggers a new record, 0 disables rtt detection
+    :return: (models.Traceroute) new traceroute object to store, or None if nothing changed
+    """
+    target = get_or_create_target(db, target)
+
+    if exit_code != 0:
+        logger.error('Cannot get traceroute for target "{0}".'.format(target.name))
+        return models.Traceroute(raw_traceroute=raw_traceroute, target_id=target.id)
+
+    # Only load the columns we need, raw traceroute is loaded later if really needed
+    previous_traceroute = db.query(models.Traceroute.id, models.Traceroute.hop_fingerprint,
+                                   models.Traceroute.hop_digest).filter(
+        models.Traceroute.target_id == target.id).order_by(models.Traceroute.id.desc()).first()
+
+    # Identical traceroutes regardless of rtts are enough to know that nothing changed when rtt detection is
+    # disabled, so we don't even need to parse the current traceroute
+    hop_digest = get_hop_digest(raw_traceroute)
+    if previous_traceroute and not rtt_detection_threshold and hop_digest == previous_traceroute.hop_digest:
+        logger.debug('Current traceroute is identical to previous one for target "{0}". Nothing to do.'.format(target.name))
+        return None
+
+    hop_fingerprint = get_hop_fingerprint(raw_traceroute)
+    current_traceroute = models.Traceroute(raw_traceroute=raw_traceroute, hop_fingerprint=hop_fingerprint,
+                                           hop_digest=hop_digest, target_id=target.id)
+    if not previous_traceroute:
+        logger.info('Created traceroute for target "{0}".'.format(target.name))
+        return current_traceroute
+
+    # Identical hops are enough to know that nothing changed when rtt detection is disabled,
+    # so we don't need to parse the previous traceroute
+    if not rtt_detection_threshold and hop_fingerprint is not None and \
+            hop_fingerprint == previous_traceroute.hop_fingerprint:
+        logger.debug('Current traceroute is identical to previous one for target "{0}". Nothing to do.'.format(target.name))
+        return None
+
+    previous_raw_traceroute = db.query(models.Traceroute.raw_traceroute).filter(
+        models.Traceroute.id == previous_traceroute.id).scalar()
+    # Unparseable traceroutes, eg when previous traceroute failed (traceroute binary missing), are never equal
+    if not traceroutes_equal(raw_traceroute, previous_raw_traceroute, rtt_detection_threshold=rtt_detection_threshold):
+        logger.info('Updating traceroute for target "{0}".'.format(target.name))
+        return current_traceroute
+    logger.debug('Current traceroute is identical to previous one for target "{0}". Nothing to do.'.format(target.name))
+    return None
+
+
+def store_traceroutes(db, new_traceroutes: list):
+    """
+    Inserts new traceroutes in one batch
+    If the batch fails, traceroutes are inserted one by one so only the failing ones are skipped
+
+    :param db: (Session) database session
+    :param new_traceroutes: (list)(schemas.TargetCreate, models.Traceroute) new traceroutes and their targets
+    :return:
+    """
+    if not new_traceroutes:
+        return
+    traceroutes = [traceroute for _, traceroute in new_traceroutes]
+    try:
+        with db.begin_nested():
+            # bulk_save_objects skips most of the unit of work overhead on large batches
+            if len(traceroutes) > BULK_INSERT_THRESHOLD:
+                db.bulk_save_objects(traceroutes)
+            else:
+                db.add_all(traceroutes)
+        return
+    except sqlalchemy.exc.SQLAlchemyError as exc:
+        logger.warning('Cannot store traceroutes in one batch, storing them one by one: {0}.'.format(exc))
+
+    for target, traceroute in new_traceroutes:
+        try:
+            with db.begin_nested():
+                db.add(traceroute)
+        except sqlalchemy.exc.SQLAlchemyError as exc:
+            logger.error('Cannot store traceroute for target "{0}": {1}.'.format(target.name, exc))
+            logger.debug('Trace:', exc_info=True)
+
+
+def update_all_targets(targets: list, loop=None):
+    """
+    Executes tracert for all given targets, and stores changed traceroutes in a single transaction
+    Every target gets it's own savepoint, so a failing target does not prevent storing the others
+
+    :param targets: (list)(schemas.TargetCreate) list of targets to probe
+    :param loop: (AbstractEventLoop) event loop reused across runs, a temporary one is created if None
     :return:
     """
 
     config = config_management.load_config(CONFIG_FILE)
+    rtt_detection_threshold = get_rtt_detection_threshold(config)
+
+    if not targets:
+        return
+
+    # Get traceroutes before opening a session, so we don't hold the database while probing
+    addresses = [str(target.address) for target in targets]
+    if loop is not None:
+        traceroutes = loop.run_until_complete(os_traceroutes(addresses))
+    else:
+        loop = new_event_loop()
+        try:
+            traceroutes = loop.run_until_complete(os_traceroutes(addresses))
+        finally:
+            loop.close()
+    results = list(zip(targets, traceroutes))
 
     with db_scoped_session() as db:
         try:
-            # Create groups if not exist
-            tgt_groups = []
-            if target.groups:
-                for group in target.groups:
-                    grp = crud.get_group(db=db, name=group.name)
-                    if not grp:
-                        grp = crud.create_group(db=db, group=group)
-                        logger.info('Created new group "{0}".'.format(group.name))
-                    tgt_groups.append(grp)
-
-            # Create targets if not exist
-            tgt = crud.get_target(db=db, name=target.name)
-            if not tgt:
-                target.groups = tgt_groups
-                target = crud.create_target(db=db, target=target)
-                logger.info('Created new target "{0}".'.format(target.name))
-            else:
-                target = tgt
-
-            # Get traceroute
-            exit_code, raw_traceroute = os_traceroute(target.address)
-            if exit_code == 0:
-                previous_traceroute = crud.get_traceroutes_by_target(db=db, target_name=target.name, limit=1)
-                if previous_traceroute:
-                    try:
-                        rtt_detection_threshold = int(config['TRACEROUTE_HISTORY']['rtt_detection_threshold'])
-                    except KeyError:
-                        rtt_detection_threshold = 0
-                    except TypeError:
-                        logger.warning('Bogus rtt_detection_threshold value.')
-                        rtt_detection_threshold = 0
-                    different_hops, increased_rtt = analyze_traceroutes(raw_traceroute, previous_traceroute[0].raw_traceroute, rtt_detection_threshold=rtt_detection_threshold)
-                    # Special case where previous traceroute is failed (traceroute binary missing) or unparseable
-                    if different_hops == None and increased_rtt == None:
-                        current_traceroute = schemas.TracerouteCreate(raw_traceroute=raw_traceroute)
-                        crud.create_target_traceroute(db=db, traceroute=current_traceroute, target_id=target.id)
-                        logger.info('Created traceroute for target "{0}" since previous traceroute is unparseable.'.format(target.name))
-                    elif different_hops or increased_rtt:
-                        current_traceroute = schemas.TracerouteCreate(raw_traceroute=raw_traceroute)
-                        crud.create_target_traceroute(db=db, traceroute=current_traceroute, target_id=target.id)
-                        logger.info('Updating traceroute for target "{0}".'.format(target.name))
-                    else:
-                        logger.debug('Current traceroute is identical to previous one for target "{0}". Nothing to do.'.format(target.name))
-                else:
-                    current_traceroute = schemas.TracerouteCreate(raw_traceroute=raw_traceroute)
-                    crud.create_target_traceroute(db=db, traceroute=current_traceroute, target_id=target.id)
-                    logger.info('Created traceroute for target "{0}".'.format(target.name))
-            else:
-                logger.error('Cannot get traceroute for target "{0}".'.format(target.name))
-                current_traceroute = schemas.TracerouteCreate(raw_traceroute=raw_traceroute)
-                crud.create_target_traceroute(db=db, traceroute=current_traceroute, target_id=target.id)
+            new_traceroutes = []
+            for target, (exit_code, raw_traceroute) in results:
+                # One savepoint per target, so a failing target does not roll back the other targets
+                try:
+                    with db.begin_nested():
+                        traceroute = update_traceroute_database(db, target, exit_code, raw_traceroute,
+                                                                rtt_detection_threshold=rtt_detection_threshold)
+                except Exception as exc:
+                    # Savepoint has been rolled back, eg unparseable previous traceroute or database error
+                    logger.error('Cannot update traceroute for target "{0}": {1}.'.format(target.name, exc))
+                    logger.debug('Trace:', exc_info=True)
+                    continue
+                if traceroute is not None:
+                    new_traceroutes.append((target, traceroute))
+            store_traceroutes(db, new_traceroutes)
         except sqlalchemy.exc.OperationalError as exc:
             logger.error('sqlalchemy operation error: {0}.'.format(exc))
             logger.error('Trace:', exc_info=True)
@@ -294,6 +590,8 @@ def get_last_traceroutes(target_name, limit=1):
 
     with db_scoped_session() as db:
         traceroutes = crud.get_traceroutes_by_target(db=db, target_name=target_name, limit=limit)
+        # Detach traceroutes so they can still be read once the session is removed
+        db.expunge_all()
         return traceroutes
 
 
@@ -303,15 +601,17 @@ def get_last_traceroutes_formatted(name, limit=1, formatting='console'):
         logger.warning('Target "{0}" has been requested but does not exist in database.'.format(name))
         return 'Target not found in database.'
     if traceroutes:
-        output = 'Target has {0} tracreoute entries.'.format(len(traceroutes))
-        length = len(traceroutes)
-        if len(traceroutes) > 1:
-            output = output + traceroutes_difference_preformatted(traceroutes[0], traceroutes[1])
-            for i in range(length - 2):
-                output = output + traceroutes[i + 2].__repr__()
+        buf = io.StringIO()
+        buf.write('Target has {0} tracreoute entries.'.format(len(traceroutes)))
+        # No need to compute differences when there's only one traceroute
+        if limit != 1 and len(traceroutes) > 1:
+            write_traceroutes_difference(buf, traceroutes[0], traceroutes[1])
+            remaining_traceroutes = traceroutes[2:]
         else:
-            for traceroute in traceroutes:
-                output = output + traceroute.__repr__()
+            remaining_traceroutes = traceroutes
+        for traceroute in remaining_traceroutes:
+            buf.write(repr(traceroute))
+        output = buf.getvalue()
     else:
         output = traceroutes
 
@@ -325,8 +625,8 @@ def list_targets(include_tr: bool=False, formatting: str='console'):
 
         targets = crud.get_targets(db=db)
         for target in targets:
-            groups = crud.get_groups_by_target(db=db, target_id=target.id)
-            traces = get_last_traceroutes(target.name, limit=2)
+            # Don't use get_last_traceroutes here since it would remove our thread local session
+            traces = crud.get_traceroutes_by_target(db=db, target_id=target.id, limit=2)
             try:
                 current_tr = traces[0]
                 current_tr_object = trparse.loads(current_tr.raw_traceroute)
@@ -342,7 +642,7 @@ def list_targets(include_tr: bool=False, formatting: str='console'):
                 previous_tr = None
                 previous_rtt = None
 
-            target = {'id': target.id, 'name': target.name, 'address': target.address, 'groups': [group.name for group in groups],
+            target = {'id': target.id, 'name': target.name, 'address': target.address, 'groups': [group.name for group in target.groups],
                            'current_rtt': current_rtt, 'previous_rtt': previous_rtt,
                            'last_probe': current_tr.creation_date }
             if include_tr:
@@ -356,40 +656,44 @@ def list_targets(include_tr: bool=False, formatting: str='console'):
         return output
 
 
-def delete_old_traceroutes(target_name: str, days: int, keep: int):
+def delete_old_traceroutes(target_names: list, days: int, keep: int):
     """
     Deletes old traceroute data if days have passed, but always keep at least limit entries
+    All targets are handled in a single transaction
 
-    :param target_name: (str) target name
+    :param target_names: (list)(str) target names
     :param days: (int) number of days after which a traceroute will be deleted
     :param keep: (int) number of traceroutes to keep regardless of the
     :return:
     """
 
+    cutoff_date = datetime.now() - timedelta(days=days)
     with db_scoped_session() as db:
-        target = crud.get_target(db=db, name=target_name)
-        if not target:
-            return None
-
-        num_records = crud.get_traceroutes_by_target(db=db, target_name=target_name, count=True)
-        if num_records > keep:
-            num_records_to_delete = num_records - keep
-
-            # TODO: IS NOT CRUD CONVERTED
-
-            # Subquery is needed because we cannot use delete() on a query with a limit
-            subquery = db.query(models.Traceroute.id).filter(and_(models.Traceroute.target == target,
-                                                                  models.Traceroute.creation_date < (datetime.now() - timedelta(
-                                                                    days=days)))).order_by(models.Traceroute.id.desc()).limit(
-                num_records_to_delete).subquery()
-            records = db.query(models.Traceroute).filter(models.Traceroute.id.in_(subquery)).delete(synchronize_session='fetch')
+        for target_name in target_names:
+            target = crud.get_target(db=db, name=target_name)
+            if not target:
+                continue
+
+            # Newest traceroute that isn't protected by keep, every traceroute up to it may be deleted
+            # We don't use a subquery with a limit in the delete statement since MySQL does not support it
+            last_deletable_id = db.query(models.Traceroute.id).filter(
+                models.Traceroute.target_id == target.id).order_by(models.Traceroute.id.desc()).offset(
+                keep).limit(1).scalar()
+            if last_deletable_id is None:
+                continue
+
+            records = db.query(models.Traceroute).filter(models.Traceroute.target_id == target.id,
+                                                         models.Traceroute.id <= last_deletable_id,
+                                                         models.Traceroute.creation_date < cutoff_date).delete(
+                synchronize_session=False)
             logger.info('Deleted {0} old records for target "{1}".'.format(records, target_name))
 
 
 def remove_target(target_name):
+    delete_old_traceroutes([target_name], 0, 0)
+    # Modify the shared config object only right before saving it, so the config cache gets invalidated
     config = config_management.load_config(CONFIG_FILE)
     config_management.remove_target_from_config(config, target_name)
-    delete_old_traceroutes(target_name, 0, 0)
     return config_management.save_config(CONFIG_FILE, config)
 
 
@@ -401,15 +705,12 @@ def execute(daemon=False):
     :return:
     """
     config = config_management.load_config(CONFIG_FILE)
-    targets = config_management.get_targets_from_config(config)
+    targets = config_management.get_target_configs(config)
 
     if len(targets) == 0:
         logger.info('No valid targets given.')
         sys.exit(20)
 
-    scheduler = BackgroundScheduler()
-    scheduler.start()
-
     # Interval between traceroute executions
     try:
         interval = int(config['TRACEROUTE_HISTORY']['interval'])
@@ -434,56 +735,70 @@ def execute(daemon=False):
         logger.error('Bogus minimum_keep value. Using default.')
         minimum_keep = 100
 
+    valid_targets = []
     for target in targets:
-        target_name = target['name']
-        target_address = target['address']
         try:
-            group_names = config_management.get_groups_from_config(config, target_name)
-            if group_names:
-                grp = [schemas.GroupCreate(name=grp_name) for grp_name in group_names]
-            else:
-                grp = None
-            tgt = schemas.TargetCreate(name=str(target_name), address=target_address, groups=grp)
-
-            job_kwargs = {
-                'target': tgt
-            }
-
-            delete_kwargs = {
-                'target_name': target_name,
-                'days': delete_history_days,
-                'keep': minimum_keep
-            }
-
-            # Immediate start
-            scheduler.add_job(update_traceroute_database, None, [], job_kwargs, name='startup-' + target_name,
-                              id='startup-' + target_name)
-            # Programmed start afterwards
-            scheduler.add_job(update_traceroute_database, 'interval', [], job_kwargs, seconds=interval,
-                              name=target_name, id=target_name)
-
-            if delete_history_days:
-                scheduler.add_job(delete_old_traceroutes, None, [], delete_kwargs,
-                                  name='startup-housekeeping-' + target_name, id='startup-housekeeping-' + target_name)
-                scheduler.add_job(delete_old_traceroutes, 'interval', [], delete_kwargs, hours=1,
-                                  name='housekeeping-' + target_name, id='housekeeping-' + target_name)
+            grp = [schemas.GroupCreate(name=grp_name) for grp_name in target.groups]
+            valid_targets.append(schemas.TargetCreate(name=target.name, address=target.address, groups=grp or None))
 
             # TODO add regular config file reloading job ?
 
-        except KeyError as exc:
-            logger.error('Failed to read configuration for target "{0}": {1}.'.format(target_name, exc))
-            logger.error(exc)
         except ValidationError as exc:
-            logger.error('Bogus target "{0}" given: {1}.'.format(target_name, exc))
+            logger.error('Bogus target "{0}" given: {1}.'.format(target.name, exc))
+
+    job_kwargs = {
+        'targets': valid_targets
+    }
+    delete_kwargs = {
+        'target_names': [target.name for target in valid_targets],
+        'days': delete_history_days,
+        'keep': minimum_keep
+    }
+
+    # Single run, no need for a scheduler
+    if not daemon:
+        update_all_targets(**job_kwargs)
+        if delete_history_days:
+            delete_old_traceroutes(**delete_kwargs)
+        return
+
+    # Probe loop is created once in the main thread and reused by every scheduled run
+    loop = new_event_loop()
+    job_kwargs['loop'] = loop
 
-    run_once = True
-    try:
-        while daemon or run_once:
-            run_once = False
-            sleep(1)
-    except KeyboardInterrupt:
-        logger.info('Interrupted by keyboard')
-        scheduler.shutdown()
+    scheduler = BackgroundScheduler()
+
+    # All targets are probed by a single job, starting immediately
+    # max_instances prevents a slow run from overlapping with the next one
+    scheduler.add_job(update_all_targets, 'interval', [], job_kwargs, seconds=interval,
+                      next_run_time=datetime.now(), max_instances=1, coalesce=True,
+                      name='update', id='update')
+
+    if delete_history_days:
+        scheduler.add_job(delete_old_traceroutes, 'interval', [], delete_kwargs, days=1,
+                          next_run_time=datetime.now(), max_instances=1, coalesce=True,
+                          name='housekeeping', id='housekeeping')
+
+    scheduler.start()
+
+    # Block until Ctrl+C or service stop
+    stop_event = threading.Event()
+
+    def _stop(signum, frame):
+        logger.info('Received {0}, stopping.'.format(signal.Signals(signum).name))
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+
+    if os.name == 'nt':
+        # Waits without timeout cannot be interrupted on Windows, signal handlers only run once we wake up
+        while not stop_event.wait(1):
+            pass
+    else:
+        stop_event.wait()
+    scheduler.shutdown()
+    loop.close()
 
 
 def help_():